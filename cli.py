@@ -0,0 +1,36 @@
+"""
+Command line entrypoint, run by cron every 15 minutes
+
+Only uses the standard library until a sync is due, so runs that aren't due
+exit before main.py's CCM and Google dependencies are imported
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from sync_schedule import get_due_sync_state
+
+
+def get_arg_parser() -> ArgumentParser:
+    parser = ArgumentParser(description="Sync Curling Club Manager games to Google Calendar")
+    parser.add_argument("--profile", nargs="?", const="./profile", metavar="DIR",
+                        help="profile each sync phase with cProfile and tracemalloc, writing results to DIR (default: ./profile)")
+    parser.add_argument("--force", action="store_true",
+                        help="sync even if the next scheduled sync isn't due yet")
+    return parser
+
+
+def run():
+    args = get_arg_parser().parse_args()
+    now = datetime.now(ZoneInfo("America/Toronto"))
+    sync_state = get_due_sync_state(now, force=args.force or bool(args.profile))
+    if sync_state is None:
+        return
+
+    from main import main
+    main(sync_state, now, profile_dir=args.profile)
+
+
+if __name__ == "__main__":
+    run()
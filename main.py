@@ -1,7 +1,13 @@
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from enum import Enum
+from functools import wraps
+from hashlib import sha1
 from json import load
-from os import path
+from os import makedirs, path
 from sys import exit
 from zoneinfo import ZoneInfo
 
@@ -12,7 +18,98 @@ from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from sync_schedule import SYNC_MAX_BACKOFF, get_next_sync, save_sync_state
+
 G_ACC_SCOPES = ["https://www.googleapis.com/auth/calendar"]
+PROFILE_TOP_N = 10
+
+# Set by main() when running with --profile
+_profiler = None
+
+
+class PhaseProfiler():
+    """
+    Records a cProfile and tracemalloc capture for each sync phase
+    Nested phases pause the enclosing phase's cProfile, so CPU time is exclusive,
+    while allocations are inclusive of nested phases
+    """
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        self._profiles = {}
+        self._allocations = {}
+        self._stack = []
+
+    def start(self):
+        makedirs(self.output_dir, exist_ok=True)
+        tracemalloc.start()
+
+    def stop(self):
+        tracemalloc.stop()
+
+    @contextmanager
+    def phase(self, name: str):
+        if self._stack:
+            self._stack[-1].disable()
+        if name not in self._profiles:
+            self._profiles[name] = cProfile.Profile()
+        profile = self._profiles[name]
+        self._stack.append(profile)
+        before = self._take_snapshot()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            after = self._take_snapshot()
+            self._stack.pop()
+            self._save_phase(name, profile, before, after)
+            if self._stack:
+                self._stack[-1].enable()
+
+    def _take_snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+
+    def _save_phase(self, name: str, profile: cProfile.Profile,
+                    before: tracemalloc.Snapshot, after: tracemalloc.Snapshot):
+        profile.dump_stats(path.join(self.output_dir, name + ".pstats"))
+        after.dump(path.join(self.output_dir, name + ".tracemalloc"))
+        allocations = after.compare_to(before, "lineno")
+        self._allocations[name] = allocations
+        with open(path.join(self.output_dir, name + ".alloc.txt"), "w") as alloc_file:
+            for stat in allocations[:PROFILE_TOP_N]:
+                alloc_file.write(str(stat) + "\n")
+
+    def get_summary(self) -> str:
+        summary = ""
+        for name, profile in self._profiles.items():
+            stats = pstats.Stats(profile)
+            allocated = sum(stat.size_diff for stat in self._allocations.get(name, []))
+            summary += "{}: {:.3f}s CPU, {:+.1f} KiB retained\n".format(
+                name, stats.total_tt, allocated / 1024)  # type: ignore
+            hot_spots = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)  # type: ignore
+            for (filename, line, func), (_, _, tottime, _, _) in hot_spots[:3]:
+                summary += "  {:.3f}s {}:{}({})\n".format(
+                    tottime, path.basename(filename), line, func)
+            for stat in self._allocations.get(name, [])[:3]:
+                frame = stat.traceback[0]
+                summary += "  {:+.1f} KiB {}:{}\n".format(
+                    stat.size_diff / 1024, path.basename(frame.filename), frame.lineno)
+        return summary.rstrip("\n")
+
+
+def profiled(func):
+    """Runs func as a named profiling phase when main() was started with --profile"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if _profiler is None:
+            return func(*args, **kwargs)
+        with _profiler.phase(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
 
 class ChangeType(Enum):
     ADDITION = 1
@@ -47,13 +144,20 @@ class Google():
         self.service = build(
             "calendar", "v3", credentials=creds)
 
+    @profiled
     def get_cal_matches(self):
         try:
             now = datetime.utcnow().isoformat() + "Z"  # "Z" indicates UTC time
-            events_result = self.service.events().list(calendarId=self.config["g_cal_id"], timeMin=now,
-                                                       maxResults=50, singleEvents=True,
-                                                       orderBy="startTime").execute()
-            events = events_result.get("items", [])
+            events = []
+            page_token = None
+            while True:
+                events_result = self.service.events().list(calendarId=self.config["g_cal_id"], timeMin=now,
+                                                           maxResults=250, singleEvents=True,
+                                                           orderBy="startTime", pageToken=page_token).execute()
+                events += events_result.get("items", [])
+                page_token = events_result.get("nextPageToken")
+                if not page_token:
+                    break
 
         except HttpError as error:
             print("An error occurred: %s" % error)
@@ -109,16 +213,51 @@ class Google():
         if change_type == ChangeType.UPDATE:
             self._sync_changes[league][ChangeType.UPDATE.name] += 1
 
-    def create_cal_match(self, title: str, description: str, start_time: datetime):
+    def _is_current_event(self, existing: dict, event: dict) -> bool:
+        if existing.get("status") == "cancelled":
+            return False
+        for key in ("summary", "description", "location"):
+            if existing.get(key, "") != event[key]:
+                return False
+        for key in ("start", "end"):
+            # All-day events only have a date
+            existing_time = existing.get(key, {}).get("dateTime")
+            if not existing_time or datetime.fromisoformat(existing_time) != datetime.fromisoformat(event[key]["dateTime"]):
+                return False
+        return True
+
+    def create_cal_match(self, event_id: str, title: str, description: str, start_time: datetime):
         event = self._generate_cal_event(title, description, start_time)
-        self.service.events().insert(
-            calendarId=self.config["g_cal_id"], body=event).execute()
+        event["id"] = event_id
+        try:
+            self.service.events().insert(
+                calendarId=self.config["g_cal_id"], body=event).execute()
+        except HttpError as error:
+            if error.resp.status != 409:
+                raise
+            # The event already exists, either from an earlier interrupted run or as a
+            # cancelled event with the same ID - overwrite it unless it's already confirmed and current
+            existing = self.service.events().get(calendarId=self.config["g_cal_id"],
+                                                 eventId=event_id).execute()
+            if self._is_current_event(existing, event):
+                print("Already added {} {}".format(title, start_time.isoformat()))
+                return
+            event["status"] = "confirmed"
+            self.service.events().update(calendarId=self.config["g_cal_id"],
+                                         eventId=event_id, body=event).execute()
         print("Added {} {}".format(title, start_time.isoformat()))
         self._add_sync_change(title, ChangeType.ADDITION)
 
     def delete_cal_match(self, event_id: str, title: str, start_time: datetime):
-        self.service.events().delete(
-            calendarId=self.config["g_cal_id"], eventId=event_id).execute()
+        try:
+            self.service.events().delete(
+                calendarId=self.config["g_cal_id"], eventId=event_id).execute()
+        except HttpError as error:
+            # 404 Not Found or 410 Gone - the event was already deleted
+            if error.resp.status not in (404, 410):
+                raise
+            print("Already removed {} {}".format(title, start_time.isoformat()))
+            return
         print("Removed {} {}".format(title, start_time.isoformat()))
         self._add_sync_change(title, ChangeType.DELETION)
 
@@ -184,6 +323,7 @@ def fill_ccm_team(soup: BeautifulSoup, ccm_matches: dict):
                     skip.split(", ")[0], team_description_text)
 
 
+@profiled
 def fill_ccm_teams(session: requests.Session, headers: dict[str, str], config: dict, ccm_leagues: dict):
     response = session.get(
         config["ccm_url"] + "/index.php/member-s-home/league-information/teams-schedules-standings?view=tss", headers=headers)
@@ -199,6 +339,7 @@ def fill_ccm_teams(session: requests.Session, headers: dict[str, str], config: d
                 fill_ccm_team(team_soup, ccm_leagues[league])
 
 
+@profiled
 def convert_ccm_matches(session, headers, config, leagues, ccm_leagues):
     for league_name in leagues:
         response = session.get(config["ccm_url"] + leagues[league_name]["link"], headers=headers)
@@ -235,16 +376,27 @@ def convert_ccm_matches(session, headers, config, leagues, ccm_leagues):
             ccm_leagues[league_name].append({
                 "datetime": match_datetime,
                 "description": "{} vs {}\nSheet {}".format(match_opp, leagues[league_name]["skip"], match_sheet),
-                "skips": [match_opp, leagues[league_name]["skip"]]
+                "skips": [match_opp, leagues[league_name]["skip"]],
+                "event_id": get_event_id(league_name, match_datetime, match_sheet)
             })
 
 
+def get_event_id(league: str, match_datetime: datetime, sheet: str) -> str:
+    """
+    Deterministic Google Calendar event ID for a CCM game
+    Event IDs may only use base32hex characters (a-v, 0-9), which hex digests satisfy
+    """
+    match_key = "{}\n{}\n{}".format(league, match_datetime.isoformat(), sheet)
+    return "ccm" + sha1(match_key.encode("utf-8")).hexdigest()
+
+
 def get_header_cookie(cookies: dict):
     for cookie in cookies.keys():
         if len(cookie) == 32:
             return "{}={}".format(cookie, cookies[cookie])
 
 
+@profiled
 def get_ccm_matches(config: dict):
     # Get initial cookies
     session = requests.Session()
@@ -321,6 +473,7 @@ def get_ccm_matches(config: dict):
     return ccm_leagues
 
 
+@profiled
 def update_calendar(google: Google, ccm_leagues: dict, cal_leagues: dict):
     for league in ccm_leagues.keys():
         ccm_index = 0
@@ -352,6 +505,7 @@ def update_calendar(google: Google, ccm_leagues: dict, cal_leagues: dict):
                     if ccm_date >= datetime.now(ZoneInfo("America/Toronto")):
                         # Add to calendar
                         google.create_cal_match(
+                            event_id=ccm_match["event_id"],
                             title=league,
                             description=ccm_match["description"],
                             start_time=ccm_match["datetime"]
@@ -368,6 +522,7 @@ def update_calendar(google: Google, ccm_leagues: dict, cal_leagues: dict):
             # Add remaining to calendar
             ccm_match = ccm_leagues[league][ccm_index]
             google.create_cal_match(
+                event_id=ccm_match["event_id"],
                 title=league,
                 description=ccm_match["description"],
                 start_time=ccm_match["datetime"]
@@ -397,8 +552,7 @@ def update_home_assistant(config: dict, message: str, success: bool):
 
         requests.post(url, headers=headers, json=request_json)
 
-def main():
-    config = load(open("config.json"))
+def sync(config: dict) -> tuple[dict, str]:
     google = Google(config)
     ccm_leagues = get_ccm_matches(config) or dict()
     if ccm_leagues:
@@ -409,6 +563,36 @@ def main():
     else:
         print("{} No upcoming matches found - skipped calendar sync".format(datetime.now().isoformat()))
         update_home_assistant(config, "No upcoming matches found - skipped calendar sync", success=True)
+    return ccm_leagues, google.get_changes()
+
+def main(sync_state: dict, sync_start: datetime, profile_dir: str | None = None):
+    """
+    Syncs the calendar and schedules the next sync
+    The next sync is measured from sync_start, so it stays aligned with the cron ticks
+    """
+    global _profiler
+    config = load(open("config.json"))
+    if profile_dir:
+        _profiler = PhaseProfiler(profile_dir)
+        _profiler.start()
+    try:
+        ccm_leagues, changes = sync(config)
+    finally:
+        if _profiler:
+            _profiler.stop()
+            print(_profiler.get_summary())
+            print("Profiles written to {}".format(profile_dir))
+            _profiler = None
+
+    if changes:
+        sync_state["unchanged_runs"] = 0
+    else:
+        sync_state["unchanged_runs"] = min(sync_state["unchanged_runs"] + 1, SYNC_MAX_BACKOFF)
+    next_sync = get_next_sync(sync_start, ccm_leagues, sync_state["unchanged_runs"])
+    sync_state["next_sync"] = next_sync.isoformat()
+    save_sync_state(sync_state)
+    print("{} Next sync due at {}".format(datetime.now().isoformat(), sync_state["next_sync"]))
 
 if __name__ == "__main__":
-    main()
+    from cli import run
+    run()
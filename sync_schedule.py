@@ -0,0 +1,94 @@
+"""
+Decides when the next calendar sync is due
+Only uses the standard library, so cli.py can check it without loading the CCM and Google dependencies
+"""
+
+from datetime import datetime, timedelta, timezone
+from json import dump, load
+from math import ceil, log2
+from os import path, replace
+
+SYNC_STATE_FILE = "./token/sync_state.json"
+# Sync interval by time until the next game, checked in order
+SYNC_INTERVALS = [
+    (timedelta(hours=6), timedelta(minutes=15)),
+    (timedelta(days=1), timedelta(hours=1)),
+    (timedelta(days=7), timedelta(hours=6)),
+]
+SYNC_MAX_INTERVAL = timedelta(days=1)
+PRE_GAME_WINDOW = SYNC_INTERVALS[0][0]
+# Enough doublings to back off from the shortest interval to the longest
+SYNC_MAX_BACKOFF = ceil(log2(SYNC_MAX_INTERVAL / SYNC_INTERVALS[0][1]))
+# Cron ticks start a little before or after the next sync time, depending on how long Python takes to start
+SYNC_DUE_GRACE = timedelta(minutes=1)
+
+
+def get_next_sync(now: datetime, ccm_leagues: dict, unchanged_runs: int) -> datetime:
+    """
+    Syncs often in the hours before a game and rarely when the next game is far away
+    Outside the pre-game window, the interval doubles for each sync that found no changes,
+    but never past the start of the next pre-game window
+    Times are compared in UTC so intervals stay exact across daylight saving changes
+    """
+    now = now.astimezone(timezone.utc)
+    upcoming = [ccm_match["datetime"].astimezone(timezone.utc) for league in ccm_leagues.values()
+                for ccm_match in league if ccm_match["datetime"] > now]
+    if not upcoming:
+        return now + SYNC_MAX_INTERVAL
+
+    until_next_game = min(upcoming) - now
+    interval = SYNC_MAX_INTERVAL
+    for window, window_interval in SYNC_INTERVALS:
+        if until_next_game <= window:
+            interval = window_interval
+            break
+    if until_next_game > PRE_GAME_WINDOW:
+        interval = min(interval * 2 ** min(unchanged_runs, SYNC_MAX_BACKOFF), SYNC_MAX_INTERVAL,
+                       until_next_game - PRE_GAME_WINDOW)
+    return now + interval
+
+
+def load_sync_state() -> dict:
+    default_state = {
+        "next_sync": None,
+        "unchanged_runs": 0
+    }
+    if not path.exists(SYNC_STATE_FILE):
+        return default_state
+    try:
+        with open(SYNC_STATE_FILE) as state_file:
+            sync_state = dict(default_state, **load(state_file))
+        if sync_state["next_sync"]:
+            datetime.fromisoformat(sync_state["next_sync"])
+        int(sync_state["unchanged_runs"])
+    except (TypeError, ValueError) as e:
+        # Sync now and overwrite the unreadable state
+        print("Error reading sync state, resetting: {}".format(e))
+        return default_state
+    return sync_state
+
+
+def save_sync_state(sync_state: dict):
+    # Write to a temporary file and swap it in, so an interrupted write can't truncate the state
+    temp_file = SYNC_STATE_FILE + ".tmp"
+    with open(temp_file, "w") as state_file:
+        dump(sync_state, state_file)
+    replace(temp_file, SYNC_STATE_FILE)
+
+
+def is_sync_due(sync_state: dict, now: datetime) -> bool:
+    if not sync_state["next_sync"]:
+        return True
+    return now + SYNC_DUE_GRACE >= datetime.fromisoformat(sync_state["next_sync"])
+
+
+def get_due_sync_state(now: datetime, force: bool = False) -> dict | None:
+    """
+    Loads the sync state if a sync should run now
+    Returns None if the next sync isn't due yet and the sync isn't forced
+    """
+    sync_state = load_sync_state()
+    if force or is_sync_due(sync_state, now):
+        return sync_state
+    print("{} Sync not due until {}".format(now.isoformat(), sync_state["next_sync"]))
+    return None
@@ -1,12 +1,39 @@
 import unittest
 from unittest.mock import MagicMock, call, patch
-from datetime import datetime
+from datetime import datetime, timedelta
+from os import listdir, path
+from tempfile import TemporaryDirectory
 from zoneinfo import ZoneInfo
 
-from main import update_calendar
+from googleapiclient.errors import HttpError
+from httplib2 import Response
+
+import cli
+from main import Google, PhaseProfiler, get_event_id, update_calendar
+from sync_schedule import get_next_sync, is_sync_due, load_sync_state, save_sync_state
 
 TIMEZONE = "America/Toronto"
 
+# Event as returned by the Calendar API for the game _make_google() would create
+EXISTING_EVENT = {
+    "status": "confirmed",
+    "summary": "Friday Night Mixed",
+    "description": "Sheet 3",
+    "location": "Club",
+    "start": {"dateTime": "2023-01-06T19:00:00-05:00"},
+    "end": {"dateTime": "2023-01-06T21:00:00-05:00"}
+}
+
+
+def _make_google() -> Google:
+    """Google client with a mocked Calendar service, skipping the OAuth flow"""
+    google = Google.__new__(Google)
+    google.config = {"g_cal_id": "cal", "match_location": "Club",
+                     "match_duration_hours": 2, "match_duration_min": 0}
+    google._sync_changes = {}
+    google.service = MagicMock()
+    return google
+
 
 class TestStringMethods(unittest.TestCase):
     def test_update_calendar_new_games_only(self):
@@ -20,24 +47,28 @@ class TestStringMethods(unittest.TestCase):
                 {
                     # 2023-01-06 19:00
                     "datetime": datetime(2023, 1, 6, 19, 0, tzinfo=ZoneInfo(TIMEZONE)),
-                    "description": "Vader, Darth vs Joker, The\nSheet: 3"
+                    "description": "Vader, Darth vs Joker, The\nSheet: 3",
+                    "event_id": "ccm202301061900"
                 },
                 {
                     # 2023-01-13 21:00
                     "datetime": datetime(2023, 1, 13, 21, 0, tzinfo=ZoneInfo(TIMEZONE)),
-                    "description": "Vader, Darth vs Erik, Killmonger\nSheet: 4"
+                    "description": "Vader, Darth vs Erik, Killmonger\nSheet: 4",
+                    "event_id": "ccm202301132100"
                 },
                 {
                     # 2023-01-20 21:00
                     "datetime": datetime(2023, 1, 20, 21, 0, tzinfo=ZoneInfo(TIMEZONE)),
-                    "description": "Vader, Darth vs Marvel, Thanos\nSheet: 1"
+                    "description": "Vader, Darth vs Marvel, Thanos\nSheet: 1",
+                    "event_id": "ccm202301202100"
                 }
             ],
             "Wednesday Night Men": [
                 {
                     # 2023-01-06 19:00
                     "datetime": datetime(2023, 1, 3, 17, 0, tzinfo=ZoneInfo(TIMEZONE)),
-                    "description": "Vader, Darth vs Luthor, Lex\nSheet: 4"
+                    "description": "Vader, Darth vs Luthor, Lex\nSheet: 4",
+                    "event_id": "ccm202301031700"
                 }
             ]
         }
@@ -60,10 +91,10 @@ class TestStringMethods(unittest.TestCase):
 
         g_mock = MagicMock()
         update_calendar(g_mock, ccm_leagues, cal_leagues)
-        calls = [call.create_cal_match(title="Friday Night Mixed", description="Vader, Darth vs Erik, Killmonger\nSheet: 4", start_time=datetime(2023, 1, 13, 21, 0, tzinfo=ZoneInfo(key="America/Toronto"))),
-                 call.create_cal_match(title="Friday Night Mixed", description="Vader, Darth vs Marvel, Thanos\nSheet: 1",
+        calls = [call.create_cal_match(event_id="ccm202301132100", title="Friday Night Mixed", description="Vader, Darth vs Erik, Killmonger\nSheet: 4", start_time=datetime(2023, 1, 13, 21, 0, tzinfo=ZoneInfo(key="America/Toronto"))),
+                 call.create_cal_match(event_id="ccm202301202100", title="Friday Night Mixed", description="Vader, Darth vs Marvel, Thanos\nSheet: 1",
                                        start_time=datetime(2023, 1, 20, 21, 0, tzinfo=ZoneInfo(key="America/Toronto"))),
-                 call.create_cal_match(title="Wednesday Night Men", description="Vader, Darth vs Luthor, Lex\nSheet: 4", start_time=datetime(2023, 1, 3, 17, 0, tzinfo=ZoneInfo(key="America/Toronto")))]
+                 call.create_cal_match(event_id="ccm202301031700", title="Wednesday Night Men", description="Vader, Darth vs Luthor, Lex\nSheet: 4", start_time=datetime(2023, 1, 3, 17, 0, tzinfo=ZoneInfo(key="America/Toronto")))]
         assert g_mock.mock_calls == calls
 
 
@@ -86,17 +117,20 @@ class TestStringMethods(unittest.TestCase):
                 {
                     # 2023-01-06 19:00
                     "datetime": datetime(2023, 1, 6, 19, 0, tzinfo=ZoneInfo(TIMEZONE)),
-                    "description": "Vader, Darth vs Joker, The\nSheet: 3"
+                    "description": "Vader, Darth vs Joker, The\nSheet: 3",
+                    "event_id": "ccm202301061900"
                 },
                 {
                     # 2023-01-13 21:00
                     "datetime": datetime(2023, 1, 13, 21, 0, tzinfo=ZoneInfo(TIMEZONE)),
-                    "description": "Vader, Darth vs Erik, Killmonger\nSheet: 4"
+                    "description": "Vader, Darth vs Erik, Killmonger\nSheet: 4",
+                    "event_id": "ccm202301132100"
                 },
                 {
                     # 2023-01-20 21:00
                     "datetime": datetime(2023, 1, 20, 21, 0, tzinfo=ZoneInfo(TIMEZONE)),
-                    "description": "Vader, Darth vs Marvel, Thanos\nSheet: 1"
+                    "description": "Vader, Darth vs Marvel, Thanos\nSheet: 1",
+                    "event_id": "ccm202301202100"
                 }
             ]
         }
@@ -136,27 +170,32 @@ class TestStringMethods(unittest.TestCase):
                 {
                     # 2023-01-06 19:00
                     "datetime": datetime(2023, 1, 6, 19, 0, tzinfo=ZoneInfo(TIMEZONE)),
-                    "description": "Gushue, Brad vs Epping, John\nSheet: 3"
+                    "description": "Gushue, Brad vs Epping, John\nSheet: 3",
+                    "event_id": "ccm202301061900"
                 },
                 {
                     # 2023-01-13 21:00
                     "datetime": datetime(2023, 1, 13, 21, 0, tzinfo=ZoneInfo(TIMEZONE)),
-                    "description": "Gushue, Brad vs Bottcher, Brendan\nSheet: 4"
+                    "description": "Gushue, Brad vs Bottcher, Brendan\nSheet: 4",
+                    "event_id": "ccm202301132100"
                 },
                 {
                     # 2023-01-20 21:00
                     "datetime": datetime(2023, 1, 20, 21, 0, tzinfo=ZoneInfo(TIMEZONE)),
-                    "description": "Gushue, Brad vs Koe, Kevin\nSheet: 1"
+                    "description": "Gushue, Brad vs Koe, Kevin\nSheet: 1",
+                    "event_id": "ccm202301202100"
                 },
                 {
                     # 2023-01-27 19:00
                     "datetime": datetime(2023, 1, 27, 19, 0, tzinfo=ZoneInfo(TIMEZONE)),
-                    "description": "Gushue, Brad vs Edin, Niklas\nSheet: 2"
+                    "description": "Gushue, Brad vs Edin, Niklas\nSheet: 2",
+                    "event_id": "ccm202301271900"
                 },
                 {
                     # 2023-02-03 21:00
                     "datetime": datetime(2023, 2, 3, 21, 0, tzinfo=ZoneInfo(TIMEZONE)),
-                    "description": "Gushue, Brad vs Moat, Bruce\nSheet: 4"
+                    "description": "Gushue, Brad vs Moat, Bruce\nSheet: 4",
+                    "event_id": "ccm202302032100"
                 },
             ]
         }
@@ -197,16 +236,16 @@ class TestStringMethods(unittest.TestCase):
 
         g_mock = MagicMock()
         update_calendar(g_mock, ccm_leagues, cal_leagues)
-        calls = [call.create_cal_match(title="Friday Night Mixed", description="Gushue, Brad vs Epping, John\nSheet: 3", start_time=datetime(2023, 1, 6, 19, 0, tzinfo=ZoneInfo(key="America/Toronto"))),
+        calls = [call.create_cal_match(event_id="ccm202301061900", title="Friday Night Mixed", description="Gushue, Brad vs Epping, John\nSheet: 3", start_time=datetime(2023, 1, 6, 19, 0, tzinfo=ZoneInfo(key="America/Toronto"))),
                  call.delete_cal_match(event_id="1", title="Friday Night Mixed", start_time=datetime(
                      2023, 1, 13, 21, 0, tzinfo=ZoneInfo(key="America/Toronto"))),
-                 call.create_cal_match(title="Friday Night Mixed", description="Gushue, Brad vs Edin, Niklas\nSheet: 2",
+                 call.create_cal_match(event_id="ccm202301271900", title="Friday Night Mixed", description="Gushue, Brad vs Edin, Niklas\nSheet: 2",
                                        start_time=datetime(2023, 1, 27, 19, 0, tzinfo=ZoneInfo(key="America/Toronto"))),
                  call.delete_cal_match(event_id="4", title="Friday Night Mixed", start_time=datetime(
                      2023, 2, 3, 21, 0, tzinfo=ZoneInfo(key="America/Toronto"))),
                  call.delete_cal_match(event_id="5", title="Friday Night Mixed", start_time=datetime(
                      2023, 2, 3, 21, 0, tzinfo=ZoneInfo(key="America/Toronto"))),
-                 call.create_cal_match(title="Friday Night Mixed", description="Gushue, Brad vs Moat, Bruce\nSheet: 4", start_time=datetime(2023, 2, 3, 21, 0, tzinfo=ZoneInfo(key="America/Toronto")))]
+                 call.create_cal_match(event_id="ccm202302032100", title="Friday Night Mixed", description="Gushue, Brad vs Moat, Bruce\nSheet: 4", start_time=datetime(2023, 2, 3, 21, 0, tzinfo=ZoneInfo(key="America/Toronto")))]
         assert g_mock.mock_calls == calls
 
     def test_update_calendar_update_game_description(self):
@@ -218,12 +257,14 @@ class TestStringMethods(unittest.TestCase):
                 {
                     # 2023-01-06 19:00
                     "datetime": datetime(2023, 1, 6, 19, 0, tzinfo=ZoneInfo(TIMEZONE)),
-                    "description": "Einarson, Kerri vs Homan, Rachel\nSheet: 3"
+                    "description": "Einarson, Kerri vs Homan, Rachel\nSheet: 3",
+                    "event_id": "ccm202301061900"
                 },
                 {
                     # 2023-01-13 21:00
                     "datetime": datetime(2023, 1, 13, 21, 0, tzinfo=ZoneInfo(TIMEZONE)),
-                    "description": "Einarson, Kerri vs Lawes, Kaitlyn\nSheet: 4"
+                    "description": "Einarson, Kerri vs Lawes, Kaitlyn\nSheet: 4",
+                    "event_id": "ccm202301132100"
                 }
             ]
         }
@@ -250,6 +291,232 @@ class TestStringMethods(unittest.TestCase):
                                        start_time=datetime(2023, 1, 6, 19, 0, tzinfo=ZoneInfo(key="America/Toronto")))]
         assert g_mock.mock_calls == calls
 
+    def test_get_event_id(self):
+        """
+        Event IDs are stable for the same game and valid Google Calendar base32hex IDs
+        """
+        start_time = datetime(2023, 1, 6, 19, 0, tzinfo=ZoneInfo(TIMEZONE))
+        event_id = get_event_id("Friday Night Mixed", start_time, "3")
+        assert event_id == get_event_id("Friday Night Mixed", start_time, "3")
+        assert event_id != get_event_id("Friday Night Mixed", start_time, "4")
+        assert event_id != get_event_id("Monday Night Open", start_time, "3")
+        assert all(c in "0123456789abcdefghijklmnopqrstuv" for c in event_id)
+
+    def test_create_cal_match_conflict(self):
+        """
+        An insert conflicting with an existing (possibly cancelled) event overwrites that event
+        """
+        google = _make_google()
+        google.service.events().insert().execute.side_effect = HttpError(Response({"status": 409}), b"")
+        google.service.events().get().execute.return_value = dict(EXISTING_EVENT, status="cancelled")
+        start_time = datetime(2023, 1, 6, 19, 0, tzinfo=ZoneInfo(TIMEZONE))
+        google.create_cal_match(event_id="ccm1", title="Friday Night Mixed",
+                                description="Sheet 3", start_time=start_time)
+
+        update_kwargs = google.service.events().update.call_args.kwargs
+        assert update_kwargs["eventId"] == "ccm1"
+        assert update_kwargs["body"]["id"] == "ccm1"
+        assert update_kwargs["body"]["status"] == "confirmed"
+        assert google.get_changes() == "Friday Night Mixed: 1 game added."
+
+    def test_create_cal_match_already_exists(self):
+        """
+        An insert conflicting with an identical confirmed event doesn't change the calendar
+        """
+        google = _make_google()
+        google.service.events().insert().execute.side_effect = HttpError(Response({"status": 409}), b"")
+        google.service.events().get().execute.return_value = EXISTING_EVENT
+        start_time = datetime(2023, 1, 6, 19, 0, tzinfo=ZoneInfo(TIMEZONE))
+        google.create_cal_match(event_id="ccm1", title="Friday Night Mixed",
+                                description="Sheet 3", start_time=start_time)
+
+        google.service.events().update.assert_not_called()
+        assert google.get_changes() == ""
+
+    def test_create_cal_match_stale_event(self):
+        """
+        An insert conflicting with a confirmed event with an outdated location, end time or
+        only an all-day date overwrites that event
+        """
+        stale_events = [
+            dict(EXISTING_EVENT, location="Old Club"),
+            dict(EXISTING_EVENT, end={"dateTime": "2023-01-06T21:30:00-05:00"}),
+            dict(EXISTING_EVENT, start={"date": "2023-01-06"}, end={"date": "2023-01-07"}),
+        ]
+        start_time = datetime(2023, 1, 6, 19, 0, tzinfo=ZoneInfo(TIMEZONE))
+        for stale_event in stale_events:
+            google = _make_google()
+            google.service.events().insert().execute.side_effect = HttpError(Response({"status": 409}), b"")
+            google.service.events().get().execute.return_value = stale_event
+            google.create_cal_match(event_id="ccm1", title="Friday Night Mixed",
+                                    description="Sheet 3", start_time=start_time)
+
+            google.service.events().update.assert_called_once()
+            assert google.get_changes() == "Friday Night Mixed: 1 game added."
+
+    def test_create_cal_match_error(self):
+        """
+        Insert errors other than a conflict are raised
+        """
+        google = _make_google()
+        google.service.events().insert().execute.side_effect = HttpError(Response({"status": 500}), b"")
+        start_time = datetime(2023, 1, 6, 19, 0, tzinfo=ZoneInfo(TIMEZONE))
+        with self.assertRaises(HttpError):
+            google.create_cal_match(event_id="ccm1", title="Friday Night Mixed",
+                                    description="Sheet 3", start_time=start_time)
+        google.service.events().update.assert_not_called()
+
+    def test_delete_cal_match_already_deleted(self):
+        """
+        Deleting an event that is already gone is not an error or a change, other delete errors are raised
+        """
+        google = _make_google()
+        start_time = datetime(2023, 1, 6, 19, 0, tzinfo=ZoneInfo(TIMEZONE))
+        for status in (404, 410):
+            google.service.events().delete().execute.side_effect = HttpError(Response({"status": status}), b"")
+            google.delete_cal_match(event_id="ccm1", title="Friday Night Mixed", start_time=start_time)
+        assert google.get_changes() == ""
+
+        google.service.events().delete().execute.side_effect = HttpError(Response({"status": 403}), b"")
+        with self.assertRaises(HttpError):
+            google.delete_cal_match(event_id="ccm1", title="Friday Night Mixed", start_time=start_time)
+
+    def test_get_next_sync(self):
+        """
+        Sync every 15 minutes on game day, back off when the next game is a week or more away
+        and never back off past the start of the pre-game window
+        """
+        now = datetime(2023, 1, 6, 12, 0, tzinfo=ZoneInfo(TIMEZONE))
+        ccm_leagues = {
+            "Friday Night Mixed": [
+                {
+                    # 2023-01-05 19:00, already played
+                    "datetime": datetime(2023, 1, 5, 19, 0, tzinfo=ZoneInfo(TIMEZONE)),
+                    "description": "Vader, Darth vs Joker, The\nSheet: 3"
+                },
+                {
+                    # 2023-01-06 17:00
+                    "datetime": datetime(2023, 1, 6, 17, 0, tzinfo=ZoneInfo(TIMEZONE)),
+                    "description": "Vader, Darth vs Erik, Killmonger\nSheet: 4"
+                }
+            ]
+        }
+        assert get_next_sync(now, ccm_leagues, 5) == now + timedelta(minutes=15)
+
+        # Next game in 17 hours, 11 hours before the pre-game window
+        now = datetime(2023, 1, 6, 0, 0, tzinfo=ZoneInfo(TIMEZONE))
+        assert get_next_sync(now, ccm_leagues, 0) == now + timedelta(hours=1)
+        assert get_next_sync(now, ccm_leagues, 2) == now + timedelta(hours=4)
+        assert get_next_sync(now, ccm_leagues, 4) == now + timedelta(hours=11)
+
+        # Backoff is capped instead of overflowing
+        assert get_next_sync(now, ccm_leagues, 1000) == now + timedelta(hours=11)
+
+        # Next game in 3 weeks
+        now = datetime(2022, 12, 16, 17, 0, tzinfo=ZoneInfo(TIMEZONE))
+        assert get_next_sync(now, ccm_leagues, 0) == now + timedelta(days=1)
+        assert get_next_sync(now, ccm_leagues, 40) == now + timedelta(days=1)
+
+        # Off-season
+        assert get_next_sync(now, {}, 0) == now + timedelta(days=1)
+
+    def test_is_sync_due(self):
+        now = datetime(2023, 1, 6, 12, 0, tzinfo=ZoneInfo(TIMEZONE))
+        assert is_sync_due({"next_sync": None, "unchanged_runs": 0}, now)
+        assert is_sync_due({"next_sync": "2023-01-06T11:45:00-05:00", "unchanged_runs": 0}, now)
+        # A cron tick that starts slightly early is still due
+        assert is_sync_due({"next_sync": "2023-01-06T12:00:05-05:00", "unchanged_runs": 0}, now)
+        assert not is_sync_due({"next_sync": "2023-01-06T12:15:00-05:00", "unchanged_runs": 0}, now)
+
+    def test_sync_state_file(self):
+        """
+        Sync state round trips through the state file, and an unreadable state file means a sync is due
+        """
+        with TemporaryDirectory() as state_dir:
+            state_path = path.join(state_dir, "sync_state.json")
+            with patch("sync_schedule.SYNC_STATE_FILE", state_path):
+                save_sync_state({"next_sync": "2023-01-06T12:15:00-05:00", "unchanged_runs": 3})
+                assert load_sync_state() == {"next_sync": "2023-01-06T12:15:00-05:00", "unchanged_runs": 3}
+                assert listdir(state_dir) == ["sync_state.json"]
+
+                with open(state_path, "w") as state_file:
+                    state_file.write('{"next_sync": "2023-01-')
+                assert load_sync_state() == {"next_sync": None, "unchanged_runs": 0}
+
+                with open(state_path, "w") as state_file:
+                    state_file.write('{"next_sync": "tomorrow", "unchanged_runs": 3}')
+                assert load_sync_state() == {"next_sync": None, "unchanged_runs": 0}
+
+    def test_get_next_sync_dst(self):
+        """
+        The pre-game window is measured in real time across the switch to daylight saving time
+        """
+        # 2023-03-11 23:30 EST, 5.5 hours before the 06:00 EDT game
+        now = datetime(2023, 3, 11, 23, 30, tzinfo=ZoneInfo(TIMEZONE))
+        ccm_leagues = {
+            "Sunday Morning Open": [
+                {
+                    # 2023-03-12 06:00
+                    "datetime": datetime(2023, 3, 12, 6, 0, tzinfo=ZoneInfo(TIMEZONE)),
+                    "description": "Vader, Darth vs Joker, The\nSheet: 3"
+                }
+            ]
+        }
+        assert get_next_sync(now, ccm_leagues, 0) == now + timedelta(minutes=15)
+
+    def test_main_cron_ticks(self):
+        """
+        Syncs taking a few seconds don't push the next sync past the following 15 minute cron tick
+        Simulates cron starting cli.py every 15 minutes from 12:00 before a 17:00 game
+        """
+        ccm_leagues = {
+            "Friday Night Mixed": [
+                {
+                    # 2023-01-06 17:00
+                    "datetime": datetime(2023, 1, 6, 17, 0, tzinfo=ZoneInfo(TIMEZONE)),
+                    "description": "Vader, Darth vs Erik, Killmonger\nSheet: 4"
+                }
+            ]
+        }
+        clock = [datetime(2023, 1, 6, 12, 0, tzinfo=ZoneInfo(TIMEZONE))]
+        sync_times = []
+
+        def mock_sync(config):
+            sync_times.append(clock[0].replace(second=0, microsecond=0))
+            clock[0] += timedelta(seconds=5)
+            return ccm_leagues, ""
+
+        ticks = [datetime(2023, 1, 6, 12, 0, tzinfo=ZoneInfo(TIMEZONE)) + timedelta(minutes=15 * i) for i in range(12)]
+        with TemporaryDirectory() as state_dir, \
+                patch("sync_schedule.SYNC_STATE_FILE", path.join(state_dir, "sync_state.json")), \
+                patch("sys.argv", ["cli.py"]), patch("cli.datetime") as mock_datetime, \
+                patch("main.sync", side_effect=mock_sync), patch("main.load"), patch("main.open", create=True):
+            mock_datetime.now.side_effect = lambda tz=None: clock[0]
+            for tick in ticks:
+                # Python takes a moment to start before the time is read
+                clock[0] = tick + timedelta(milliseconds=300)
+                cli.run()
+        assert sync_times == ticks
+
+    def test_phase_profiler_nested_phases(self):
+        """
+        Nested phases each write their own pstats and allocation files
+        """
+        with TemporaryDirectory() as profile_dir:
+            profiler = PhaseProfiler(profile_dir)
+            profiler.start()
+            with profiler.phase("outer"):
+                with profiler.phase("inner"):
+                    [str(i) for i in range(1000)]
+            profiler.stop()
+
+            assert sorted(listdir(profile_dir)) == [
+                "inner.alloc.txt", "inner.pstats", "inner.tracemalloc",
+                "outer.alloc.txt", "outer.pstats", "outer.tracemalloc"]
+            summary = profiler.get_summary()
+            assert summary.startswith("outer: ")
+            assert "\ninner: " in summary
+
 
 if __name__ == "__main__":
     unittest.main()